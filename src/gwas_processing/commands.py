@@ -1,14 +1,18 @@
+import os
+import secrets
+import shutil
 from pathlib import Path
 from typing import Optional, Tuple, Union
 
-from src.gwas_processing.utils import run_magma
+from src.gwas_processing.utils import get_annotation_cache_key, run_magma
 
 
 def annotate_variants(
     gene_loc: str,
     snp_loc: str,
-    output_prefix: str,
+    output_prefix: Union[str, os.PathLike],
     annotation_window: Optional[Tuple[int, int]],
+    cache_dir: Optional[str] = None,
 ) -> Tuple[Path, Path]:
     """
     from the MAGMA documentation - "the annotation step is a pre-processing step prior to the
@@ -20,24 +24,47 @@ def annotate_variants(
     :param output_prefix: the prefix for each output of the MAGMA annotation step
     :param annotation_window: window to use around each gene to associate SNPs outside the main gene body
         with the gene
+    :param cache_dir: optional directory to cache annotation outputs in. if the same gene location
+        file, SNP location file, and annotation window were annotated before, the cached outputs are
+        copied to the output prefix instead of re-running MAGMA
     :return: the output annotation files
     """
+    output_prefix = os.fspath(output_prefix)
+    annotation_output = Path(f"{output_prefix}.genes.annot")
+    annotation_log = Path(f"{output_prefix}.log")
+
+    if cache_dir:
+        cache_key = get_annotation_cache_key(gene_loc, snp_loc, annotation_window)
+        cached_output = Path(cache_dir, f"{cache_key}.genes.annot")
+        cached_log = Path(cache_dir, f"{cache_key}.log")
+
+        if cached_output.exists() and cached_log.exists():
+            print(f"Using cached annotation output {cached_output}")
+            shutil.copyfile(cached_output, annotation_output)
+            shutil.copyfile(cached_log, annotation_log)
+
+            return annotation_output, annotation_log
+
+    # remove any previous outputs so that a stale output can't pass the checks below
+    annotation_output.unlink(missing_ok=True)
+    annotation_log.unlink(missing_ok=True)
 
     no_arg_flags = ["--annotate"]
     yes_arg_flags = {
-        "window": f"{annotation_window[0]},{annotation_window[1]}" if annotation_window else None,
         "--gene-loc": gene_loc,
         "--snp-loc": snp_loc,
         "--out": output_prefix,
     }
 
-    # this comes after since the order of arguments in `yes_arg_flags` is respected when passed to sh.Command
-    if not annotation_window:
-        del yes_arg_flags["window"]
+    # the window modifier goes first since the order of arguments in `yes_arg_flags` is respected
+    # when passed to sh.Command
+    if annotation_window:
+        yes_arg_flags = {
+            "window": f"{annotation_window[0]},{annotation_window[1]}",
+            **yes_arg_flags,
+        }
 
     run_magma(no_arg_flags, yes_arg_flags)
-    annotation_output = Path(f"{output_prefix}.genes.annot")
-    annotation_log = Path(f"{output_prefix}.log")
 
     assert (
         annotation_output.exists()
@@ -46,6 +73,15 @@ def annotate_variants(
         annotation_log.exists()
     ), f"Something went wrong in the annotation step; no annotation log was produced"
 
+    # write cache entries under a temporary name first so that concurrent runs never read
+    # a partially written entry
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        for output, cached in [(annotation_output, cached_output), (annotation_log, cached_log)]:
+            tmp_cached = f"{cached}.{secrets.token_hex(nbytes=8)}.tmp"
+            shutil.copyfile(output, tmp_cached)
+            os.replace(tmp_cached, cached)
+
     return annotation_output, annotation_log
 
 
@@ -56,8 +92,9 @@ def gene_analysis(
     variant_id: str,
     pval: str,
     n: Union[int, str],
-    output_prefix: str,
-) -> Tuple[Path, Path, Path, Path]:
+    output_prefix: Union[str, os.PathLike],
+    genes_only: bool = False,
+) -> Tuple[Path, Optional[Path], Path, Path]:
     """
     wrapper for conducting gene analysis on GWAS results in the form of an SNP-wise p-value file
 
@@ -72,9 +109,13 @@ def gene_analysis(
         case-control studies. if a str, specifies a column in the p-value file that contains the sample
         size used per SNP
     :param output_prefix: where output from this command should be output
-    :return: the output of the MAGMA gene-analysis step. should be
+    :param genes_only: whether to skip creating the .genes.raw file, which is only needed for
+        downstream gene-set analysis in MAGMA. significantly reduces running time and memory
+    :return: the output of the MAGMA gene-analysis step. the .genes.raw output is None if
+        genes_only is set
     """
-    no_arg_flags = []
+    output_prefix = os.fspath(output_prefix)
+    no_arg_flags = ["--genes-only"] if genes_only else []
     yes_arg_flags = {
         "--bfile": bfile,
         "--gene-annot": gene_annot,
@@ -96,7 +137,7 @@ def gene_analysis(
 
     gene_analysis_log = Path(f"{output_prefix}.log")
     gene_analysis_supplemental_log = Path(f"{output_prefix}.log.suppl")
-    gene_analysis_raw = Path(f"{output_prefix}.genes.raw")
+    gene_analysis_raw = None if genes_only else Path(f"{output_prefix}.genes.raw")
     gene_analysis_out = Path(f"{output_prefix}.genes.out")
 
     assert (
@@ -106,7 +147,7 @@ def gene_analysis(
         gene_analysis_supplemental_log.exists()
     ), f"Something went wrong in the gene analysis step; no analysis supplemental log was produced"
     assert (
-        gene_analysis_raw.exists()
+        genes_only or gene_analysis_raw.exists()
     ), f"Something went wrong in the gene analysis step; no analysis raw output was produced"
     assert (
         gene_analysis_out.exists()
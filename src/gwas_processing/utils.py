@@ -1,13 +1,30 @@
+import gzip
+import hashlib
 import os
 import re
 import shutil
-from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import sh
 
-from src.utils import detect_delimiter
+from src.utils import detect_delimiter_from_line, move_output
+
+# patterns used to infer the columns of a GWAS p-value file when they aren't explicitly passed
+_PAT_PVAL = re.compile(r"^p.?(val)?", flags=re.IGNORECASE)
+_PAT_VARIANT_ID = re.compile(r"^(snp)|(variant)", flags=re.IGNORECASE)
+_PAT_N = re.compile(r"^n$", flags=re.IGNORECASE)
+_PAT_CHR = re.compile(r"^chr", flags=re.IGNORECASE)
+_PAT_BP = re.compile(r"^(bp)|(base.?pair)")
+_PAT_REF_ALLELE = re.compile(r"^(ref(erence)?)|(other)|(major)")
+_PAT_EFFECT_ALLELE = re.compile(r"^(effect)|(minor)")
+
+# string columns of a GWAS p-value file are stored as Arrow-backed strings, which are far
+# more compact than one Python str object per row
+_STRING_DTYPE = "string[pyarrow]"
 
 
 def run_magma(no_arg_flags: List, yes_arg_flags: Dict):
@@ -31,6 +48,38 @@ def run_magma(no_arg_flags: List, yes_arg_flags: Dict):
     magma(command_list)
 
 
+def get_annotation_cache_key(
+    gene_loc: Union[str, Path],
+    snp_loc: Union[str, Path],
+    annotation_window: Optional[Tuple[int, int]],
+) -> str:
+    """
+    make a key identifying the inputs of a MAGMA annotation step. the gene location file is a
+    fixed reference, so it's identified by its inode, modification time, and size without being
+    read. the SNP location file is rewritten into a new working directory on every run, so it's
+    identified by a hash of its contents
+
+    :param gene_loc: path to the gene location file
+    :param snp_loc: path to the SNP location file
+    :param annotation_window: window used around each gene in the annotation step
+    :return: a hex digest identifying the annotation inputs
+    """
+    key = hashlib.sha256()
+
+    gene_loc_stat = os.stat(gene_loc)
+    key.update(
+        f"{gene_loc_stat.st_ino}:{gene_loc_stat.st_mtime_ns}:{gene_loc_stat.st_size}|".encode()
+    )
+
+    with open(snp_loc, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            key.update(block)
+
+    key.update(f"|{annotation_window}".encode())
+
+    return key.hexdigest()
+
+
 def munge_gwas(
     gwas_pval: Path,
     variant_id: Optional[str] = None,
@@ -40,6 +89,7 @@ def munge_gwas(
     bp: Optional[str] = None,
     ref_allele: Optional[str] = None,
     effect_allele: Optional[str] = None,
+    chunksize: int = 1_000_000,
 ):
     """
     format a GWAS p-value file such that it's useable by MAGMA
@@ -56,37 +106,39 @@ def munge_gwas(
         missing its ID. if no value is provided, attempt to infer
     :param effect_allele: the effect allele column. used to generate a filler ID if a variant is
         missing its ID. if no value is provided, attempt to infer
+    :param chunksize: the number of rows of the GWAS file to read and munge at a time
     :return:
     """
-    # find the columns in the p-value file that MAGMA actually uses
-    with open(gwas_pval, "r") as infile:
+    # find the columns in the p-value file that MAGMA actually uses. the header is read once
+    # and reused for detecting the delimiter
+    opener = gzip.open if str(gwas_pval).endswith(".gz") else open
+    with opener(gwas_pval, "rt") as infile:
         header = infile.readline()
 
-    delimiter = detect_delimiter(gwas_pval)
+    delimiter = detect_delimiter_from_line(header)
     header = header.strip().split(delimiter)
 
     column_patterns = {
-        "pval": pval if pval else re.compile(r"^p.?(val)?", flags=re.IGNORECASE),
-        "variant_id": variant_id
-        if variant_id
-        else re.compile(r"^(snp)|(variant)", flags=re.IGNORECASE),
-        "n": n if n else re.compile(r"^n$", flags=re.IGNORECASE),
-        "chr": chromosome if chromosome else re.compile(r"^chr", flags=re.IGNORECASE),
-        "bp": bp if bp else re.compile(r"^(bp)|(base.?pair)"),
-        "ref_allele": ref_allele
-        if ref_allele
-        else re.compile(r"^(ref(erence)?)|(other)|(major)"),
-        "effect_allele": effect_allele
-        if effect_allele
-        else re.compile(r"^(effect)|(minor)"),
+        "pval": pval if pval else _PAT_PVAL,
+        "variant_id": variant_id if variant_id else _PAT_VARIANT_ID,
+        "n": n if n else _PAT_N,
+        "chr": chromosome if chromosome else _PAT_CHR,
+        "bp": bp if bp else _PAT_BP,
+        "ref_allele": ref_allele if ref_allele else _PAT_REF_ALLELE,
+        "effect_allele": effect_allele if effect_allele else _PAT_EFFECT_ALLELE,
     }
 
-    for idx, column in enumerate(header):
-        for key in column_patterns:
-            if isinstance(column_patterns[key], re.Pattern) and column_patterns[
-                key
-            ].search(column):
+    # the first header column matching a pattern is used for that pattern. stop looking
+    # once every pattern has been resolved to a column
+    unresolved = {key for key, value in column_patterns.items() if isinstance(value, re.Pattern)}
+    for column in header:
+        if not unresolved:
+            break
+
+        for key in list(unresolved):
+            if column_patterns[key].search(column):
                 column_patterns[key] = column
+                unresolved.discard(key)
 
     # assert that columns for the variant ID and p-value exist in the file
     assert isinstance(column_patterns["pval"], str)
@@ -99,64 +151,163 @@ def munge_gwas(
     ]
     core_dtypes = {
         column_patterns["pval"]: float,
-        column_patterns["variant_id"]: str,
-        column_patterns["effect_allele"]: str,
+        column_patterns["variant_id"]: _STRING_DTYPE,
+        column_patterns["effect_allele"]: _STRING_DTYPE,
     }
 
     # if a sample size column is included per SNP, include that too for parsing the file
     if isinstance(column_patterns["n"], str):
         core_cols.append(column_patterns["n"])
-        core_cols[column_patterns["n"]] = "Int64"
-
-    # try to lazily load the gwas p-value file by not loading the chromosome, base pair,
-    # reference allele, or effect allele information unless variant IDs are missing
-    gwas = pd.read_csv(
-        gwas_pval, sep=delimiter, usecols=core_cols, dtype=core_dtypes
-    )
+        core_dtypes[column_patterns["n"]] = "Int64"
 
-    # if there are any missing variant IDs, fill using the hg19 format:
-    # [CHR]_[BP]_[REF ALLELE]_[EFFECT ALLELE]
-    if any(gwas[variant_id].isna()):
-        filler_cols = [
-            column_patterns["chr"],
-            column_patterns["bp"],
-            column_patterns["ref_allele"],
-        ]
-        filler_dtypes = {
-            column_patterns["chr"]: str,
-            column_patterns["bp"]: "Int64",
-            column_patterns["ref_allele"]: str,
-        }
-
-        extension = pd.read_csv(
-            gwas_pval, sep=delimiter, usecols=filler_cols, dtype=filler_dtypes
-        )
-
-        gwas = pd.concat([gwas, extension], axis=1)
-        null_id_mask = gwas[column_patterns["variant_id"]].isna()
-        gwas_null_id = gwas[null_id_mask]
-
-        filler_cols.append(column_patterns["effect_allele"])
-        gwas.loc[null_id_mask, column_patterns["variant_id"]] = gwas_null_id[
-            filler_cols
-        ].apply(lambda x: "_".join(x.values.astype(str)), axis=1)
-
-    # need to remove variants where there isn't an effect allele
-    gwas = gwas[~gwas[column_patterns["effect_allele"]].isna()]
-
-    # MAGMA doesn't accept p-values <= 1e-308
-    # convert p-values below this value to the floor value
-    gwas.loc[
-        gwas[column_patterns["pval"]] < 9.9999999999999999e-307, column_patterns["pval"]
-    ] = 9.9999999999999999e-307
+    # the chromosome and base pair columns are always part of the output. the reference allele
+    # is only needed for generating filler IDs, so it's loaded if it could be found
+    assert isinstance(column_patterns["chr"], str)
+    assert isinstance(column_patterns["bp"], str)
+    filler_cols = [column_patterns["chr"], column_patterns["bp"]]
+    filler_dtypes = {
+        column_patterns["chr"]: _STRING_DTYPE,
+        column_patterns["bp"]: "Int64",
+    }
+    if isinstance(column_patterns["ref_allele"], str):
+        filler_cols.append(column_patterns["ref_allele"])
+        filler_dtypes[column_patterns["ref_allele"]] = _STRING_DTYPE
 
     # the annotation step requires the first three columns of the SNP location file
     # to be the SNP ID, chromosome, and base pair location. any additional columns are ignored
-    gwas = gwas[[
+    final_cols = [
         column_patterns["variant_id"],
         column_patterns["chr"],
         column_patterns["bp"],
         column_patterns["pval"],
-    ]]
+    ]
+
+    # read the gwas p-value file in a single pass, one chunk at a time, so that only the
+    # munged subset of each chunk is held in memory. the pyarrow engine can't read in chunks,
+    # so the C parser is used explicitly
+    gwas_chunks = list()
+    for chunk in pd.read_csv(
+        gwas_pval,
+        sep=delimiter,
+        engine="c",
+        usecols=core_cols + filler_cols,
+        dtype={**core_dtypes, **filler_dtypes},
+        chunksize=chunksize,
+    ):
+        # if there are any missing variant IDs, fill using the hg19 format:
+        # [CHR]_[BP]_[REF ALLELE]_[EFFECT ALLELE]
+        null_id_mask = chunk[column_patterns["variant_id"]].isna()
+        if null_id_mask.any():
+            assert isinstance(
+                column_patterns["ref_allele"], str
+            ), f"Found variants with missing IDs but no reference allele column to generate filler IDs"
+
+            # build the filler IDs with a vectorized string join rather than a per-row apply
+            filler_ids = [
+                chunk.loc[null_id_mask, column].astype(_STRING_DTYPE)
+                for column in [*filler_cols, column_patterns["effect_allele"]]
+            ]
+            chunk.loc[null_id_mask, column_patterns["variant_id"]] = filler_ids[0].str.cat(
+                filler_ids[1:], sep="_"
+            )
+
+        # MAGMA doesn't accept p-values <= 1e-308
+        # convert p-values below this value to the floor value
+        chunk[column_patterns["pval"]] = np.maximum(
+            chunk[column_patterns["pval"]].to_numpy(), 9.9999999999999999e-307
+        )
+
+        # need to remove variants where there isn't an effect allele, and variants that are still
+        # missing an ID because part of their filler ID was missing. an empty ID would shift the
+        # remaining columns of the whitespace delimited SNP location file
+        chunk = chunk[
+            ~chunk[column_patterns["effect_allele"]].isna()
+            & ~chunk[column_patterns["variant_id"]].isna()
+        ]
+
+        gwas_chunks.append(chunk[final_cols])
+
+    gwas = pd.concat(gwas_chunks)
 
     return gwas
+
+
+def _munged_gwas_name(gwas_pval: Path) -> str:
+    """
+    make the file name of a munged GWAS file from its GWAS p-value file by stripping only the
+    known compression and table suffixes
+
+    :param gwas_pval: a GWAS p-value file
+    :return: the file name of the munged GWAS file
+    """
+    if gwas_pval.suffix == ".gz":
+        gwas_pval = Path(gwas_pval.stem)
+    if gwas_pval.suffix in {".tsv", ".txt", ".csv"}:
+        gwas_pval = Path(gwas_pval.stem)
+
+    return f"{gwas_pval.name}.munged.tsv"
+
+
+def _munge_gwas_to_file(gwas_pval: Path, munged_gwas: Path, **kwargs) -> Path:
+    """
+    munge a GWAS p-value file and write the result to a file
+
+    :param gwas_pval: a GWAS p-value file
+    :param munged_gwas: the path to write the munged GWAS file to
+    :param kwargs: keyword arguments passed to munge_gwas
+    :return: the path to the munged GWAS file
+    """
+    gwas = munge_gwas(gwas_pval, **kwargs)
+
+    # MAGMA annotate expects that the output is whitespace delimited
+    gwas.to_csv(munged_gwas, index=False, sep="\t")
+
+    return munged_gwas
+
+
+def munge_gwas_batch(
+    gwas_pvals: List[Union[str, Path]],
+    output_dir: str,
+    work_dir: str,
+    workers: Optional[int] = None,
+    **kwargs,
+) -> List[Path]:
+    """
+    munge a batch of GWAS p-value files in parallel, one file per worker process
+
+    each worker holds a chunk of its GWAS file in memory at a time, so expect to need ~2GB of RAM
+    per worker. on machines with less than ~2GB per core, set the number of workers to
+    min(cpu count, RAM in GB // 2)
+
+    :param gwas_pvals: the GWAS p-value files to munge
+    :param output_dir: location to move the munged GWAS files to
+    :param work_dir: the working directory to write the munged GWAS files to before they're moved
+    :param workers: the number of worker processes. defaults to the number of CPUs
+    :param kwargs: keyword arguments passed to munge_gwas for every file
+    :return: the paths to the munged GWAS files in the output directory
+    """
+    gwas_pvals = [Path(gwas_pval) for gwas_pval in gwas_pvals]
+
+    # every munged GWAS file shares the working and output directories, so their names need
+    # to be unique before any work is submitted
+    munged_names = [_munged_gwas_name(gwas_pval) for gwas_pval in gwas_pvals]
+    duplicate_names = sorted({name for name in munged_names if munged_names.count(name) > 1})
+    if duplicate_names:
+        raise ValueError(
+            f"GWAS p-value files would produce munged files with the same name: "
+            f"{', '.join(duplicate_names)}. Rename the GWAS p-value files so that their names "
+            f"are unique"
+        )
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(
+                _munge_gwas_to_file, gwas_pval, Path(f"{work_dir}/{munged_name}"), **kwargs
+            )
+            for gwas_pval, munged_name in zip(gwas_pvals, munged_names)
+        ]
+        munged_gwas = [future.result() for future in futures]
+
+    move_output(output_dir, *munged_gwas)
+
+    return [Path(f"{output_dir}/{munged.name}") for munged in munged_gwas]
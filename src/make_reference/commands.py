@@ -8,6 +8,8 @@ import sh
 import src.make_reference.utils as utils
 from src.make_reference.classes import BFileSet
 
+_VARIANT_RE = re.compile(r"rs\d+")
+
 
 def prune_problem_variants(bfiles: List, work_dir: str) -> None:
     """
@@ -18,25 +20,25 @@ def prune_problem_variants(bfiles: List, work_dir: str) -> None:
     :param work_dir: the working directory for the reference-making process
     :return:
     """
-    with open(f"{work_dir}/merge-merge.missnp", "r") as infile:
-        merge_problem_variants = list()
-        for line in infile.readlines():
-            variant_search = re.search(r"rs\d+", line)
+    work_dir = os.fspath(work_dir)
+    missnp = os.path.join(work_dir, "merge-merge.missnp")
+    exclude = os.path.join(work_dir, "exclude_merge_variants.txt")
+
+    # stream error-causing variant IDs straight into the exclusion file
+    with open(missnp, "r") as infile, open(exclude, "w") as outfile:
+        for line in infile:
+            variant_search = _VARIANT_RE.search(line)
             if variant_search:
-                merge_problem_variants.append(variant_search.group(0))
-
-    os.rename(f"{work_dir}/merge-merge.missnp", f"{work_dir}/failed_merge.missnp")
-    os.rename(f"{work_dir}/merge.log", f"{work_dir}/failed_merge.log")
+                outfile.write(f"{variant_search.group(0)}\n")
 
-    with open(f"{work_dir}/exclude_merge_variants.txt", "w") as outfile:
-        outfile.write("\n".join(merge_problem_variants))
+    os.rename(missnp, os.path.join(work_dir, "failed_merge.missnp"))
+    os.rename(os.path.join(work_dir, "merge.log"), os.path.join(work_dir, "failed_merge.log"))
 
-    flags = dict()
+    flags = {"--exclude": exclude}
     for bfile in bfiles:
         print(f"Pruning problem variants from {bfile}")
-        flags["--bfile"] = f"{bfile}"
-        flags["--exclude"] = f"{work_dir}/exclude_merge_variants.txt"
-        flags["--out"] = f"{work_dir}/{os.path.basename(bfile)}.pruned"
+        flags["--bfile"] = bfile
+        flags["--out"] = os.path.join(work_dir, f"{os.path.basename(bfile)}.pruned")
 
         utils.run_plink(no_arg_flags=["--make-bed"], yes_arg_flags=flags)
 
@@ -45,14 +47,29 @@ def keep_bfiles(bfile_sets: Dict[str, BFileSet], keep: List[str]) -> None:
     """
     only keep bfile sets that will merged
 
-    :params keep: expect string patterns corresponding to bfile sets that should be kept
+    :params keep: expect string patterns corresponding to bfile sets that should be kept. if no
+        patterns are passed, all bfile sets are kept
     :return: None
     """
-    to_keep = re.compile("|".join([f"({pattern})" for pattern in keep]))
+    if not keep:
+        return
+
+    # plain substring checks are enough when none of the patterns use regex syntax
+    if all(re.escape(pattern) == pattern for pattern in keep):
+        to_keep = set(keep)
+
+        def is_kept(bfile_set: str) -> bool:
+            return any(pattern in bfile_set for pattern in to_keep)
+
+    else:
+        to_keep = re.compile("|".join([f"({pattern})" for pattern in keep]))
+
+        def is_kept(bfile_set: str) -> bool:
+            return bool(to_keep.search(bfile_set))
 
     to_remove = list()
     for bfile_set in bfile_sets:
-        if not re.search(to_keep, bfile_set):
+        if not is_kept(bfile_set):
             to_remove.append(bfile_set)
 
     for bfile_set in to_remove:
@@ -77,17 +94,21 @@ def merge_bfiles(
     keep_bfiles(bfile_sets, keep)
     to_merge = list(bfile_sets.keys())
 
+    work_dir = os.fspath(work_dir)
+    merge_list = os.path.join(work_dir, "merge_list.txt")
+    merge_prefix = os.path.join(work_dir, output_prefix)
+
     # make a temp file containing bfiles to merge into the main bfile
     # per PLINK's workflow for merging bfile sets
-    with open(f"{work_dir}/merge_list.txt", "w") as outfile:
+    with open(merge_list, "w") as outfile:
         outfile.write("\n".join(to_merge[1:]))
 
     try:
         print(f"Attempting to merge bfile sets {to_merge}")
         flags = dict()
         flags["--bfile"] = to_merge[0]
-        flags["--merge-list"] = f"{work_dir}/merge_list.txt"
-        flags["--out"] = f"{work_dir}/{output_prefix}"
+        flags["--merge-list"] = merge_list
+        flags["--out"] = merge_prefix
         utils.run_plink(no_arg_flags=["--make-bed"], yes_arg_flags=flags)
 
     # handle the case where the merge doesn't work due to a small-subset of variants
@@ -98,7 +119,7 @@ def merge_bfiles(
         )
         prune_problem_variants(to_merge, work_dir)
         pruned_bfiles = [
-            f"{work_dir}/{os.path.basename(bfile)}.pruned" for bfile in bfile_sets
+            os.path.join(work_dir, f"{os.path.basename(bfile)}.pruned") for bfile in bfile_sets
         ]
         flags["--bfile"] = pruned_bfiles[0]
         print(f"Retrying bfile set merge...")
@@ -106,9 +127,9 @@ def merge_bfiles(
         print(f"...success")
 
     # check that the merged files exist
-    merged_bed = Path(f"{work_dir}/{output_prefix}.bed")
-    merged_bim = Path(f"{work_dir}/{output_prefix}.bim")
-    merged_fam = Path(f"{work_dir}/{output_prefix}.fam")
+    merged_bed = Path(f"{merge_prefix}.bed")
+    merged_bim = Path(f"{merge_prefix}.bim")
+    merged_fam = Path(f"{merge_prefix}.fam")
 
     assert merged_bed.exists(), f"Something went wrong; {merged_bed} doesn't exist"
     assert merged_bim.exists(), f"Something went wrong; {merged_bim} doesn't exist"
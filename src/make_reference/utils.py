@@ -2,11 +2,29 @@ import os
 import re
 import shutil
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Union
 
 import sh
 from src.make_reference.classes import Ancestry, BFileType, BFileSet
 
+_ANCESTRY_RE = re.compile(r"(?:^|[^a-z])(amr|eas|eur|sas|afr)(?:[^a-z]|$)")
+_VALID_SUFFIXES = {bfile_type.value for bfile_type in BFileType}
+
+
+def _walk(root: Union[Path, str]) -> Iterator[os.DirEntry]:
+    """
+    recursively yield the non-directory entries under a directory
+
+    :param root: the directory to walk
+    :return: an iterator over the DirEntry of each file under the directory
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path)
+            else:
+                yield entry
+
 
 def use_bfiles(bfile_dir: Union[Path, str], *args: Ancestry) -> Dict[str, BFileSet]:
     """
@@ -16,69 +34,51 @@ def use_bfiles(bfile_dir: Union[Path, str], *args: Ancestry) -> Dict[str, BFileS
     :param args: expects a list of Ancestry enums
     :return: list of bfiles to attempt to merge
     """
-    bfile_sets = dict()
-    for root, _, files in os.walk(bfile_dir):
-        for file in files:
-            bfile_path = Path(f"{root}/{file}")
-            try:
-                # validate that the bfile type is a standard PLINK bfile type by trying to create
-                # a BFileType enum based on the file extension
-                bfile_type = BFileType(bfile_path.suffix)
-                bfile_prefix = f"{bfile_path.parent}/{bfile_path.stem}"
-
-                # validate that the bfile ancestry is supported by trying to create
-                # an Ancestry enum based on a regex search for standard 1k genome ancestry strings
-                ancestry = re.search(
-                    r"(?<=[^A-Za-z])((amr)|(eas)|(eur)|(sas)|(afr))(?=[^A-Za-z])",
-                    str(bfile_path),
-                    flags=re.IGNORECASE,
-                )
-                ancestry = Ancestry(ancestry.group().lower())
-
-                # only add bfile paths for the ancestries that need to be merged
-                if ancestry not in args:
-                    continue
-
-            # only handle recognized PLINK bfile types (bed, bim fam)
-            except ValueError:
-                continue
-
-            if bfile_prefix not in bfile_sets:
-                bfile_sets[bfile_prefix] = {
-                    "BED": None,
-                    "BIM": None,
-                    "FAM": None,
-                    "ANCESTRY": None,
-                }
-            elif bfile_prefix in bfile_sets and all(bfile_sets[bfile_prefix].values()):
-                bfile_files_w_prefix = "\n".join(bfile_sets[bfile_prefix].values())
-                raise KeyError(
-                    f"All bfiles with stem {bfile_prefix} have already been found:\n"
-                    f"---\n{bfile_files_w_prefix}\n--- "
-                    f"but an additional bfile: \n{bfile_path}\n was found that seems to be for "
-                    f"the same ancestry. Check that only one bfile set for {bfile_prefix} "
-                    f"exists in the passed reference bfile directory"
-                )
-
-            match bfile_type:
-                case BFileType.BED:
-                    bfile_sets[bfile_prefix]["BED"] = bfile_path
-
-                case BFileType.BIM:
-                    bfile_sets[bfile_prefix]["BIM"] = bfile_path
-
-                case BFileType.FAM:
-                    bfile_sets[bfile_prefix]["FAM"] = bfile_path
-
-                case _:
-                    raise ValueError(f"Unexpected bfile type for bfile {bfile_path}")
-
-            bfile_sets[bfile_prefix]["ANCESTRY"] = ancestry
-
-    # convert each sub-dictionary to a BFileSet for more comprehensible access to bfile paths
-    # also validates that each PLINK bfile sets is a complete set of 3 bfiles + an ancestry
-    for bfile_stem in bfile_sets:
-        bfile_sets[bfile_stem] = BFileSet.model_validate(bfile_sets[bfile_stem])
+    # map each bfile prefix to its path for each bfile type, and to its ancestry
+    bfiles = {bfile_type: dict() for bfile_type in BFileType}
+    ancestries = dict()
+    for entry in _walk(bfile_dir):
+        # only handle recognized PLINK bfile types (bed, bim fam)
+        name = entry.name
+        dot = name.rfind(".")
+        suffix = name[dot:] if dot > 0 else ""
+        if suffix not in _VALID_SUFFIXES:
+            continue
+
+        # find the bfile ancestry with a search for standard 1k genome ancestry strings
+        # in the bfile stem. bfiles without a supported ancestry are skipped
+        stem = name[:dot]
+        ancestry = _ANCESTRY_RE.search(stem.lower())
+        if not ancestry:
+            continue
+        ancestry = Ancestry(ancestry.group(1))
+
+        # only add bfile paths for the ancestries that need to be merged
+        if ancestry not in args:
+            continue
+
+        bfile_prefix = f"{os.path.dirname(entry.path)}/{stem}"
+        bfiles[BFileType(suffix)][bfile_prefix] = Path(entry.path)
+        ancestries[bfile_prefix] = ancestry
+
+    # only complete PLINK bfile sets of 3 bfiles + an ancestry are kept
+    bfile_sets = {
+        bfile_prefix: BFileSet(
+            BED=bfiles[BFileType.BED][bfile_prefix],
+            BIM=bfiles[BFileType.BIM][bfile_prefix],
+            FAM=bfiles[BFileType.FAM][bfile_prefix],
+            ANCESTRY=ancestry,
+        )
+        for bfile_prefix, ancestry in ancestries.items()
+        if all(bfile_prefix in bfiles[bfile_type] for bfile_type in BFileType)
+    }
+
+    incomplete_bfile_sets = [
+        bfile_prefix for bfile_prefix in ancestries if bfile_prefix not in bfile_sets
+    ]
+    if incomplete_bfile_sets:
+        print("Skipping incomplete bfile sets that are missing a bed, bim, or fam file: ")
+        print("\n".join(incomplete_bfile_sets))
 
     print("Available bfile sets that match ancestry: ")
     print("\n".join(bfile_sets))
@@ -34,34 +34,38 @@ def load_gene_name_map(
     if not delimiter:
         delimiter = detect_delimiter(gene_name_map)
 
+    # only read the ID and name columns with the C parser. positional columns are converted to
+    # column names when there is a header, since pandas can't mix names and positions in usecols
     if header:
-        gene_name_map = pd.read_csv(gene_name_map, sep=delimiter)
+        if isinstance(id_column, int) or isinstance(name_column, int):
+            columns = pd.read_csv(gene_name_map, sep=delimiter, nrows=0).columns
+            if isinstance(id_column, int):
+                id_column = columns[id_column]
+            if isinstance(name_column, int):
+                name_column = columns[name_column]
+
+        gene_name_map = pd.read_csv(
+            gene_name_map,
+            sep=delimiter,
+            usecols=[id_column, name_column],
+            engine="c",
+            low_memory=False,
+        )
     else:
-        gene_name_map = pd.read_csv(gene_name_map, sep=delimiter, header=None)
-
-    try:
-        if isinstance(id_column, str):
-            gene_ids = gene_name_map.loc[:, id_column]
-        elif isinstance(id_column, int):
-            gene_ids = gene_name_map.iloc[:, id_column]
-    except Exception as e:
-        raise e
-
-    try:
-        if isinstance(name_column, str):
-            gene_names = gene_name_map.loc[:, name_column]
-        elif isinstance(name_column, int):
-            gene_names = gene_name_map.iloc[:, name_column]
-    except Exception as e:
-        raise e
-
-
-    gene_name_map = (
-        pd.concat([gene_ids, gene_names], axis=1)
-        .set_index(gene_name_map.columns[id_column])
-        .to_dict(orient="dict")
-        .get(gene_name_map.columns[name_column])
-    )
+        assert isinstance(id_column, int) and isinstance(name_column, int), (
+            "If the gene name map file has no header, requires an int be passed as the ID and "
+            "name columns"
+        )
+        gene_name_map = pd.read_csv(
+            gene_name_map,
+            sep=delimiter,
+            header=None,
+            usecols=[id_column, name_column],
+            engine="c",
+            low_memory=False,
+        )
+
+    gene_name_map = dict(zip(gene_name_map[id_column], gene_name_map[name_column]))
 
     return gene_name_map
 
@@ -98,32 +102,42 @@ def munge_magma(
     if not delimiter:
         delimiter = detect_delimiter(associated_genes)
 
+    # only the gene and p-value columns are used, so skip parsing the rest of the file
     if header:
-        trait_gene_set = pd.read_csv(associated_genes, sep=delimiter)
-        trait_gene_set.rename(
-            columns={
-                gene_column: "GENE",
-                pvalue_column: "P",
-            }, inplace=True
+        trait_gene_set = pd.read_csv(
+            associated_genes,
+            sep=delimiter,
+            usecols=[gene_column, pvalue_column],
+            dtype={gene_column: "string", pvalue_column: "float64"},
         )
     else:
-        trait_gene_set = pd.read_csv(associated_genes, header=None, sep=delimiter)
         assert isinstance(gene_column, int), "If the trait-associated gene file has no header, " \
                                              "requires an int be passed as the gene column"
         assert isinstance(pvalue_column, int), "If the trait-associated gene file has no header, " \
                                                "requires an int be passed as the p-value column"
-        trait_gene_set.rename(
-            columns={
-                trait_gene_set.columns[gene_column]: "GENE",
-                trait_gene_set.columns[pvalue_column]: "P",
-            }
+        trait_gene_set = pd.read_csv(
+            associated_genes,
+            header=None,
+            sep=delimiter,
+            usecols=[gene_column, pvalue_column],
+            dtype={gene_column: "string", pvalue_column: "float64"},
         )
 
+    trait_gene_set.rename(
+        columns={
+            gene_column: "GENE",
+            pvalue_column: "P",
+        }, inplace=True
+    )
+
+    # genes that aren't in the map keep their original IDs. gene IDs are read as strings,
+    # so the map's IDs are converted to match
     if gene_name_map:
-        trait_gene_set[gene_column].replace(gene_name_map, inplace=True)
+        gene_name_map = {str(gene_id): gene_name for gene_id, gene_name in gene_name_map.items()}
+        gene_ids = trait_gene_set["GENE"]
+        trait_gene_set["GENE"] = gene_ids.map(gene_name_map).fillna(gene_ids)
 
-    trait_gene_set.sort_values(by=["P"], inplace=True)
-    trait_gene_set = ",".join(trait_gene_set.loc[:num_genes, "GENE"])
+    trait_gene_set = ",".join(trait_gene_set.nsmallest(num_genes, "P")["GENE"])
 
     gene_set_out = Path(f"{work_dir}/{associated_genes.stem}.gs")
     header = ["TRAIT", "GENESET"]
@@ -1,4 +1,3 @@
-import csv
 import os
 from pathlib import Path
 from typing import Tuple, Union
@@ -14,9 +13,24 @@ def detect_delimiter(infile: Path) -> str:
     :return: the column/field delimiter as a string
     """
     with open(infile, "r") as infile:
-        delimiter = str(csv.Sniffer().sniff(infile.readline()).delimiter)
+        line = infile.readline()
 
-    return delimiter
+    return detect_delimiter_from_line(line)
+
+
+def detect_delimiter_from_line(line: str) -> str:
+    """
+    find the column/field delimiter in an already read line (e.g. the header) of a file
+
+    :param line: the line to detect the column/field delimiter for
+    :return: the column/field delimiter as a string
+    """
+    # count each candidate delimiter in the line and take the most frequent one,
+    # defaulting to a tab if none of the candidates are found
+    counts = {delimiter: line.count(delimiter) for delimiter in ("\t", ",", ";", "|", " ")}
+    delimiter = max(counts, key=counts.get)
+
+    return delimiter if counts[delimiter] > 0 else "\t"
 
 
 def make_dir(parent_dir: str, dir_name: str = "") -> str: